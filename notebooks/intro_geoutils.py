@@ -35,6 +35,9 @@
 # +
 import matplotlib.pyplot as plt
 import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from shapely.geometry import box
 # %matplotlib widget
 
 import geoutils as gu
@@ -56,7 +59,8 @@ print(xdem.examples.get_path("longyearbyen_glacier_outlines"))
 
 # ## Read the two DEMs and glacier outlines for the region ###
 
-# Raster files (e.g. GeoTiff) can be loaded in one line with `gu.Raster(path_to_file)`.
+# Raster files (e.g. GeoTiff) can be loaded in one line with `gu.Raster(path_to_file)`. \
+# Loading is lazy by default: opening the file only reads its metadata (CRS, size, bounds...), and the pixel values are read from disk the first time they are accessed.
 
 dem_2009 = gu.Raster(xdem.examples.get_path("longyearbyen_ref_dem"))
 dem_1990 = gu.Raster(xdem.examples.get_path("longyearbyen_tba_dem"))
@@ -72,20 +76,24 @@ dem_1990 = gu.Raster(xdem.examples.get_path("longyearbyen_tba_dem"))
 
 outlines_1990 = gu.Vector(xdem.examples.get_path("longyearbyen_glacier_outlines"))
 
+# NB: reading a shapefile goes through GDAL/OGR feature by feature. For large vector files that are read many times, it can pay off to convert them once to the columnar GeoParquet format (`gdf.to_parquet(...)`), which is faster to read and smaller on disk, and load it with `gu.Vector(gpd.read_parquet(...))`. For a file read once, as here, the conversion costs more than it saves.
+
 # ## Quickly visualize a raster
 # Since a Raster object comes with all atributes, it can be quickly plotted with its georeferencing information.
 
 fig, ax = plt.subplots(figsize=(8, 6))
-dem_2009.show()
+dem_2009.show(ax=ax)
 plt.show()
 
+# NB: `show` passes the full-resolution array to Matplotlib, which then downsamples it to the screen resolution. For rasters much larger than the screen (several thousands of pixels wide), plotting a subsampled array instead, e.g. `ax.imshow(raster.data[::step, ::step], extent=...)`, is much faster.
+
 # It is easier to visualize as a hillshade
 
 # +
 dem_2009_hs = xdem.terrain.hillshade(dem_2009)
 
 fig, ax = plt.subplots(figsize=(8, 6))
-dem_2009_hs.show(cmap='gray')
+dem_2009_hs.show(ax=ax, cmap='gray')
 plt.show()
 # -
 
@@ -136,7 +144,7 @@ print(dem_2009.info())
 dem_2009.data
 
 # ### `gu.Vector` instances are based upon geopandas. 
-# The class contains several useful methods (`self.create_mask` is showcased below), and the underlying GeoPandas' Data Frame can accessed via:
+# The class contains several useful methods (e.g. `self.reproject` or `self.create_mask`, see the documentation), and the underlying GeoPandas' Data Frame can accessed via:
 
 outlines_1990.ds
 
@@ -145,19 +153,17 @@ outlines_1990.ds
 # **xDEM** enables calculating many terrain attributes: slope, aspect, hillshade, curbature etc. The full list is available here: https://xdem.readthedocs.io/en/stable/terrain.html
 #
 # Here we will demonstrate a few of them.
+#
+# Several attributes can be requested at once with `xdem.terrain.get_terrain_attribute`. Slope and aspect are both derived from the same elevation gradients, which are then calculated only once instead of once per attribute.
 
-# ### Slope
-
-slope = xdem.terrain.slope(dem_1990)
-fig, ax = plt.subplots(figsize=(8, 6))
-slope.show(cbar_title="Slope (degrees)")
-plt.show()
+slope, aspect = xdem.terrain.get_terrain_attribute(dem_1990, attribute=["slope", "aspect"])
 
-# ### Aspect
+# ### Slope and aspect
+# Both attributes are displayed side by side in a single figure, which is set up only once.
 
-aspect = xdem.terrain.aspect(dem_1990)
-fig, ax = plt.subplots(figsize=(8, 6))
-aspect.show(cbar_title="Aspect (degrees)", cmap="twilight")
+fig, (ax_slope, ax_aspect) = plt.subplots(1, 2, figsize=(16, 6))
+slope.show(ax=ax_slope, cbar_title="Slope (degrees)")
+aspect.show(ax=ax_aspect, cbar_title="Aspect (degrees)", cmap="twilight")
 plt.show()
 
 # #### <span style='color:red '> **TO DO:** </span> 
@@ -168,7 +174,7 @@ plt.show()
 # +
 # rugosity = xdem.terrain.???(dem_1990)
 # fig, ax = plt.subplots(figsize=(8, 6))
-# rugosity.show(cbar_title="...", cmap="...")
+# rugosity.show(ax=ax, cbar_title="...", cmap="...")
 # plt.show()
 
 # +
@@ -178,9 +184,10 @@ plt.show()
 # # Raster operations
 
 # ## Reproject the two DEMs on the same grid
-# NB: Here the function returns a warning because the two DEMs are already on the same grid, so nothing is actually done.
+# NB: Here the two DEMs are already on the same grid. In that case, `reproject` returns the DEM unchanged with a warning and no warping is done; checking the grids first only skips the warning and the allocation of an output buffer.
 
-dem_1990 = dem_1990.reproject(dst_ref=dem_2009)
+if not dem_1990.georeferenced_grid_equal(dem_2009):
+    dem_1990 = dem_1990.reproject(dst_ref=dem_2009)
 
 # Check that both DEMs indeed have the same grid
 
@@ -210,27 +217,38 @@ print(dem_test.info())
 
 # #### **Question:** What is the new pixel resolution? What are the units?
 
+# NB: each call above warps all the pixels. For large rasters where only the new georeferencing is of interest, rasterio's [`WarpedVRT`](https://rasterio.readthedocs.io/en/stable/topics/virtual-warping.html) gives the output metadata without warping any pixel.
+
 # ## Reproject the outlines in the same coordinate system as DEMs
 
 outlines_proj = outlines_1990.reproject(dst_crs=dem_2009.crs)
 
+# The outlines cover all of Svalbard, while the DEMs only cover the area around Longyearbyen. We filter them once with a spatial index query to keep only the glaciers intersecting the DEM extent, which are the only ones needed for plotting and rasterizing below.
+
+dem_extent = box(*dem_2009.bounds)
+outlines_local = gu.Vector(outlines_proj.ds.iloc[outlines_proj.ds.sindex.query(dem_extent, predicate="intersects")])
+
 # # Calculating the difference between two DEMs
 
 ddem = dem_2009 - dem_1990
 
+# For the statistics below, we keep the values and the valid pixels of the elevation change as plain numpy arrays.
+
+dh, dh_valid = np.ma.getdata(ddem.data), ~np.ma.getmaskarray(ddem.data)
+
 # ## Plot the elevation change map
 # #### Note: 
 # - `ax` is used here to share the same subplot between the raster and outlines (the default is to create a new figure)
-# - ddem is plotted last, to preserve the extent, as glacier outlines cover all of Svalbard.
+# - ddem is plotted last, to preserve the extent, as the selected glacier outlines extend beyond the DEM.
 # - zorder is used to plot in the right sequence (outlines on top)
 # - we save the figure to a png file with command `plt.savefig`. You can use a different dpi setting to change the image resolution/size.
 
-# Here we automatically calculate the min and max value for the color scale (vmin, vmax). We take the maximum absolute elevation change value. Since the colorbar is divergent (red for negative values, blue for positive) it only makes sense if centered on 0, so we set vmin=-vmax.
+# Here we automatically calculate the min and max value for the color scale (vmin, vmax). We take the maximum absolute elevation change value. Since the colorbar is divergent (red for negative values, blue for positive) it only makes sense if centered on 0, so we set vmin=-vmax. Taking the absolute value of the extrema of the valid pixels (rather than the maximum of `np.abs(ddem.data)`) avoids creating a full-size copy of the raster.
 
-vmax = np.max(np.abs(ddem.data))
+vmax = float(max(abs(dh.min(where=dh_valid, initial=np.inf)), abs(dh.max(where=dh_valid, initial=-np.inf))))
 
 fig, ax = plt.subplots(figsize=(10, 8))
-outlines_proj.show(ax=ax, facecolor='none', edgecolor='k', zorder=2)
+outlines_local.show(ax=ax, facecolor='none', edgecolor='k', zorder=2)
 ddem.show(ax=ax, cmap='RdYlBu', vmin=-vmax, vmax=vmax, cbar_title='Elevation change 2009 - 1990 (m)', zorder=1)
 ax.set_title('Thinning glaciers near Longyearbyen')
 plt.tight_layout()
@@ -247,7 +265,7 @@ plt.show()
 
 # +
 # fig, ax = plt.subplots(figsize=(10, 8))
-# outlines_proj.show(ax=ax, facecolor='none', edgecolor='...', zorder=2)
+# outlines_local.show(ax=ax, facecolor='none', edgecolor='...', zorder=2)
 # ddem.show(ax=ax, cmap='coolwarm', vmin=..., vmax=..., cbar_title='Elevation change 2009 - 1990 (m)', zorder=1)
 # ax.set_title('...')
 # plt.tight_layout()
@@ -256,28 +274,54 @@ plt.show()
 
 # ## Saving the elevation change to GTiff
 
-# If you want to export the results to a GTiff for archiving or analyzing in another software (e.g. QGIS), here's how to do it.
+# If you want to export the results to a GTiff for archiving or analyzing in another software (e.g. QGIS), here's how to do it. \
+# Writing the file in compressed 256x256 tiles makes it smaller on disk, and lets software that only displays part of the raster read just the tiles it needs.
 
-ddem.save("temp_ddem.tif")
+ddem.save(
+    "temp_ddem.tif",
+    compress="deflate",
+    tiled=True,
+    co_opts={"blockxsize": 256, "blockysize": 256, "predictor": 3, "num_threads": "all_cpus", "bigtiff": "if_safer"},
+)
 
 # # Calculate zonal statistics
 # Here we want to calculate the mean elevation change on and off glaciers.
 
 # ## Rasterize the glacier outlines on the same grid as ddem
-# `glacier_mask` is `True` on glaciers, `False` elsewhere.
+# `glacier_mask` is `True` on glaciers, `False` elsewhere. \
+# We only need a boolean array here, so we rasterize the reprojected outlines near Longyearbyen directly with rasterio's `geometry_mask` instead of building a georeferenced mask with `outlines_1990.create_mask(ddem)`. \
+# The rasterization falls back to a much slower algorithm when the output does not fit in GDAL's cache, so we temporarily increase it to 1 GB (the value is given in bytes).
+
+# +
+with rasterio.Env(GDAL_CACHEMAX=1_073_741_824):
+    glacier_mask = geometry_mask(
+        outlines_local.ds.geometry, out_shape=(ddem.height, ddem.width), transform=ddem.transform, invert=True
+    )
 
-glacier_mask = outlines_1990.create_mask(ddem)
-glacier_mask.show(add_cbar=False)
+fig, ax = plt.subplots(figsize=(8, 6))
+ax.imshow(glacier_mask, extent=(ddem.bounds.left, ddem.bounds.right, ddem.bounds.bottom, ddem.bounds.top))
+plt.show()
+# -
 
 # ### Calculate mean dh over glaciers or stable terrain
+# Rather than indexing `ddem` twice with `glacier_mask` and `~glacier_mask` (which copies the data each time), we sum the valid pixels of each class in a single pass with `np.bincount`: class 0 is stable terrain, class 1 is glaciers. The plain `dh` and `dh_valid` arrays calculated with the elevation difference are reused here.
+
+# +
+valid = dh_valid.ravel()
+on_glacier = glacier_mask.ravel()[valid].astype(np.int8)
+
+sums = np.bincount(on_glacier, weights=dh.ravel()[valid], minlength=2)
+counts = np.bincount(on_glacier, minlength=2)
+mean_stable, mean_glacier = sums / counts
+# -
 
 # Over glaciers:
 
-print(np.mean(ddem[glacier_mask]))
+print(mean_glacier)
 
 # Over stable terrain
 
-print(np.mean(ddem[~glacier_mask]))
+print(mean_stable)
 
 
 